@@ -14,4 +14,4 @@
 
 from .fs import LocalFS, HDFSClient
 from .ps_util import DistributedInfer
-from .recompute import recompute
+from .recompute import recompute, recompute_sequential
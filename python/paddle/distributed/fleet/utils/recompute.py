@@ -16,85 +16,157 @@ import paddle
 from paddle.fluid import core
 from paddle.autograd import PyLayer
 from paddle.fluid import framework
+from paddle.framework.random import get_cuda_rng_state, set_cuda_rng_state
+from paddle.device import get_device
+import collections
 import contextlib
+import math
+import os
 
 import logging
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S')
 
+# bind the helpers once, recompute calls them on every segment in both
+# forward and backward
+# NOTE paddle is still being imported when this module loads, so take them
+# from their defining modules instead of the paddle namespace
+_get_cuda_rng_state = get_cuda_rng_state
+_set_cuda_rng_state = set_cuda_rng_state
+_get_device = get_device
+_HAS_GPU = core.is_compiled_with_cuda()
+_dygraph_tracer = framework._dygraph_tracer
 
-def detach_variable(inputs):
-    out = []
-    for inp in inputs:
-        if not isinstance(inp, core.VarBase):
-            out.append(inp)
-            continue
+
+def _preserve_rng_default():
+    # default of recompute(preserve_rng_state=...), export
+    # PADDLE_RECOMPUTE_PRESERVE_RNG_DEFAULT=0 to skip rng capture by default
+    # when no recompute block uses dropout or other random ops
+    value = os.getenv("PADDLE_RECOMPUTE_PRESERVE_RNG_DEFAULT", "1").lower()
+    return value not in ("0", "false", "off")
+
+
+_PRESERVE_RNG_DEFAULT = _preserve_rng_default()
+
+def detach_variable(inputs, _VarBase=core.VarBase):
+    def _detach(inp):
+        if not isinstance(inp, _VarBase):
+            return inp
 
         x = inp.detach()
         x.stop_gradient = inp.stop_gradient
-        out.append(x)
-    return tuple(out)
+        return x
+
+    return tuple(_detach(inp) for inp in inputs)
+
+
+# everything backward needs to recompute a segment
+_RecomputeState = collections.namedtuple('_RecomputeState', [
+    'run_function', 'preserve_rng_state', 'inputs', 'tensor_indices',
+    'fw_cuda_rng_state', 'single_output', 'output_tensor_indices',
+    'offload_places'
+])
+
 
+def _offload_tensor(tensor):
+    if not tensor.place.is_gpu_place():
+        return tensor
+    # non-blocking, the source is kept alive until the copy completes. NOTE
+    # the copy runs on the compute stream, so it does not overlap with compute
+    pinned = tensor._copy_to(core.CUDAPinnedPlace(), False)
+    pinned.stop_gradient = tensor.stop_gradient
+    return pinned
 
-def check_recompute_necessary(inputs):
-    if not any(input_.stop_gradient == False for input_ in inputs
-               if isinstance(input_, paddle.Tensor)):
-        logging.warn(
-            "[Recompute]: None of the inputs to current recompute block need grad, "
-            "therefore there is NO need to recompute this block in backward !")
+
+def _reload_tensor(tensor, place):
+    if not place.is_gpu_place():
+        return tensor
+    x = tensor._copy_to(place, False)
+    x.stop_gradient = tensor.stop_gradient
+    return x
 
 
 @contextlib.contextmanager
 def swith_rng_state(rng_state):
-    orig_cuda_rng_state = paddle.get_cuda_rng_state()
-    paddle.set_cuda_rng_state(rng_state)
+    orig_cuda_rng_state = _get_cuda_rng_state()
+    _set_cuda_rng_state(rng_state)
     try:
         yield
     finally:
-        paddle.set_cuda_rng_state(orig_cuda_rng_state)
+        _set_cuda_rng_state(orig_cuda_rng_state)
 
 
 class RecomputeFunction(PyLayer):
     @staticmethod
-    def forward(ctx, run_function, preserve_rng_state, *args):
-        check_recompute_necessary(args)
-
-        # store for recomputing 
-        ctx.run_function = run_function
-        ctx.preserve_rng_state = preserve_rng_state
-
+    def forward(ctx, run_function, preserve_rng_state, offload, *args):
         # NOTE the number of outputs of backward() should be equal to the number of tensors in forward()'s input
         # the order of tensors in backward()'s output should be the same as tensors in forward()'s input
         # None tensor inputs will be filtered in backward inputs.
 
-        # save input for backward
-        ctx.inputs = []
-        ctx.tensor_indices = []
+        # save input for backward, checking whether recompute is necessary in the same pass
+        inputs = [None] * len(args)
+        tensor_indices = []
         tensor_inputs = []
+        tensor_indices_append = tensor_indices.append
+        tensor_inputs_append = tensor_inputs.append
+        need_grad = False
         for i, arg in enumerate(args):
-            if paddle.is_tensor(arg):
-                tensor_inputs.append(arg)
-                ctx.tensor_indices.append(i)
-                ctx.inputs.append(None)
+            if isinstance(arg, core.VarBase):
+                tensor_indices_append(i)
+                tensor_inputs_append(arg)
+                need_grad = need_grad or not arg.stop_gradient
             else:
-                ctx.inputs.append(arg)
-        ctx.save_for_backward(*tensor_inputs)
+                inputs[i] = arg
+        if not need_grad:
+            logging.warn(
+                "[Recompute]: None of the inputs to current recompute block need grad, "
+                "therefore there is NO need to recompute this block in backward !")
+        offload_places = None
+        if tensor_inputs:
+            if offload:
+                # keep the checkpointed inputs in pinned host memory until backward
+                offload_places = tuple(t.place for t in tensor_inputs)
+                tensor_inputs = [_offload_tensor(t) for t in tensor_inputs]
+            ctx.save_for_backward(*tensor_inputs)
 
         # NOTE recompute with restore RNG only support one senario where one process for one cuda gpu.
         # one process with multiple gpu and mix-gpu-cpu senarios are not support
-        if ctx.preserve_rng_state:
-            cur_device = paddle.get_device()
-            if 'gpu:' not in cur_device:
+        fw_cuda_rng_state = None
+        if preserve_rng_state:
+            # builds without cuda can never hold a cuda rng state, skip the
+            # device query and only ask for the device name to report it
+            if not _HAS_GPU or not _get_device().startswith('gpu:'):
                 raise RuntimeError(
                     "Recompute with RNG perserve is not support current device: {}.".
-                    format(cur_device))
-            ctx.fw_cuda_rng_state = paddle.get_cuda_rng_state()
+                    format(_get_device()))
+            fw_cuda_rng_state = _get_cuda_rng_state()
 
         # TODO support AMP
 
-        with paddle.no_grad():
+        # same as paddle.no_grad(), without the context manager on every segment
+        tracer = _dygraph_tracer()
+        has_grad = tracer._has_grad
+        tracer._has_grad = False
+        try:
             outputs = run_function(*args)
+        finally:
+            tracer._has_grad = has_grad
+
+        # NOTE outputs are produced under no_grad here, so only their positions are
+        # recorded, stop_gradient is checked on the recomputed outputs in backward
+        single_output = not isinstance(outputs, (tuple, list))
+        flat_outputs = (outputs, ) if single_output else outputs
+        output_tensor_indices = tuple(
+            i for i, out in enumerate(flat_outputs)
+            if isinstance(out, core.VarBase))
+
+        # store for recomputing, packed in one attribute instead of one ctx
+        # attribute each
+        ctx.state = _RecomputeState(
+            run_function, preserve_rng_state, inputs,
+            tuple(tensor_indices), fw_cuda_rng_state, single_output,
+            output_tensor_indices, offload_places)
 
         return outputs
 
@@ -102,39 +174,46 @@ class RecomputeFunction(PyLayer):
     def backward(ctx, *args):
         with paddle.fluid.dygraph.guard():
             # TODO need to check the recompute calling is vaild or not
+            state = ctx.state
 
             # Restore inputs
-            inputs = list(ctx.inputs)
-            tensor_indices = ctx.tensor_indices
+            inputs = state.inputs[:]
+            tensor_indices = state.tensor_indices
             tensors = ctx.saved_tensor()
+            if state.offload_places is not None:
+                tensors = [
+                    _reload_tensor(t, place)
+                    for t, place in zip(tensors, state.offload_places)
+                ]
             for i, idx in enumerate(tensor_indices):
                 inputs[idx] = tensors[i]
 
             # paddle.enable_grad()
-            tracer = framework._dygraph_tracer()
+            tracer = _dygraph_tracer()
             tracer._has_grad = True
 
             # TODO support AMP
 
-            if ctx.preserve_rng_state:
-                with swith_rng_state(ctx.fw_cuda_rng_state):
-                    detached_inputs = detach_variable(tuple(inputs))
-                    outputs = ctx.run_function(*detached_inputs)
+            # without tensor inputs there is nothing to detach
+            detached_inputs = detach_variable(
+                inputs) if tensor_indices else inputs
+            if state.preserve_rng_state:
+                with swith_rng_state(state.fw_cuda_rng_state):
+                    outputs = state.run_function(*detached_inputs)
             else:
-                detached_inputs = detach_variable(tuple(inputs))
-                outputs = ctx.run_function(*detached_inputs)
+                outputs = state.run_function(*detached_inputs)
 
-            if isinstance(outputs, core.VarBase):
+            # the recomputed outputs have the same structure as in forward
+            if state.single_output:
                 outputs = (outputs, )
             assert len(outputs) == len(args)
 
             # run backward() with only tensor that requires grad
-            forward_outputs_with_grad = []
+            forward_outputs_with_grad = [
+                outputs[idx] for idx in state.output_tensor_indices
+                if not outputs[idx].stop_gradient
+            ]
             backward_inputs = list(args)
-            for i in range(len(outputs)):
-                if isinstance(outputs[i],
-                              core.VarBase) and not outputs[i].stop_gradient:
-                    forward_outputs_with_grad.append(outputs[i])
             if len(forward_outputs_with_grad) == 0:
                 raise RuntimeError(
                     "none of output has requires_grad=True, this recompute() is not necessary"
@@ -148,12 +227,83 @@ class RecomputeFunction(PyLayer):
             # actually backward            
             paddle.autograd.backward(forward_outputs_with_grad, backward_inputs)
 
-            grads = list(inp._grad_ivar() for inp in detached_inputs
-                         if isinstance(inp, core.VarBase))
+            # tensor positions are known from forward, no need to probe types again
+            grads = [
+                detached_inputs[idx]._grad_ivar() for idx in tensor_indices
+            ]
 
             return grads
 
 
+def _save_matmul_policy(layer):
+    # NOTE only paddle.nn.Linear is matched, other matmul based layers such as
+    # convolutions or MultiHeadAttention are recomputed like any other layer
+    return isinstance(layer, paddle.nn.Linear)
+
+
+# a policy tells whether the output of a layer should be kept in forward
+# instead of being recomputed in backward
+_RECOMPUTE_POLICIES = {
+    'save_all': lambda layer: True,
+    'save_nothing': lambda layer: False,
+    'save_matmul': _save_matmul_policy,
+}
+
+
+def _run_layers(layers):
+    def run_function(input):
+        for layer in layers:
+            input = layer(input)
+        return input
+
+    return run_function
+
+
+def _recompute_with_policy(function, policy, preserve_rng_state, offload,
+                           *args):
+    if isinstance(policy, str):
+        if policy not in _RECOMPUTE_POLICIES:
+            raise ValueError(
+                "Unsupported recompute policy: {}, expected one of [{}] or a callable".
+                format(policy, ",".join(sorted(_RECOMPUTE_POLICIES))))
+        policy = _RECOMPUTE_POLICIES[policy]
+    elif not callable(policy):
+        raise ValueError(
+            "The recompute policy should be a str or a callable, but got {}".
+            format(type(policy)))
+
+    # only the sublayers of a Sequential run in a known order, any other
+    # function is either saved or recomputed as a whole
+    if not isinstance(function, paddle.nn.Sequential):
+        if policy(function):
+            return function(*args)
+        return RecomputeFunction.apply(function, preserve_rng_state, offload,
+                                       *args)
+
+    if len(args) != 1:
+        raise ValueError(
+            "Sequential takes exactly one input, but got {} inputs".format(
+                len(args)))
+
+    # saved layers run with grad and keep their activations, every run of
+    # consecutive unsaved layers becomes one recompute segment
+    output = args[0]
+    segment = []
+    for layer in function._sub_layers.values():
+        if not policy(layer):
+            segment.append(layer)
+            continue
+        if segment:
+            output = RecomputeFunction.apply(
+                _run_layers(segment), preserve_rng_state, offload, output)
+            segment = []
+        output = layer(output)
+    if segment:
+        output = RecomputeFunction.apply(
+            _run_layers(segment), preserve_rng_state, offload, output)
+    return output
+
+
 def recompute(function, *args, **kwargs):
     """
     recompute intermediate activations to save then memory.
@@ -163,15 +313,112 @@ def recompute(function, *args, **kwargs):
         intermediate activations will be released to save memory in forward stage and will be recomputed 
         in backward stage for gradient calculation.
         preserve_rng_state(bool, optional):  if preserve the RNG state of forward and restore it in backward. 
+        Default True, PADDLE_RECOMPUTE_PRESERVE_RNG_DEFAULT=0 overrides it. False skips the capture.
+        policy(str|callable, optional): decides which layers keep their activations instead of being 
+        recomputed. One of 'save_all', 'save_nothing', 'save_matmul' (saves paddle.nn.Linear layers only, 
+        other matmul based layers are recomputed), or a callable taking a layer and returning True if its 
+        output should be saved. For a paddle.nn.Sequential the policy is applied to 
+        each sublayer, otherwise to function as a whole. Default None, recompute the whole function.
+        offload(bool, optional): if move the tensor inputs of function to CUDA pinned memory in forward 
+        and copy them back to GPU in backward. It only frees the GPU memory held by these inputs 
+        between forward and backward, function is still recomputed in backward. The copies are issued 
+        on the compute stream, so they do not overlap with computation and add two serialized PCIe 
+        copies per segment on top of the recompute cost. Default False.
         args: inputs to the function
 
     Returns:
         Output of function on args
     """
     # Hack to mix *args with **kwargs in a python 2.7-compliant way
-    preserve = kwargs.pop('preserve_rng_state', True)
+    preserve = kwargs.pop('preserve_rng_state', _PRESERVE_RNG_DEFAULT)
+    policy = kwargs.pop('policy', None)
+    offload = kwargs.pop('offload', False)
+    if kwargs:
+        raise ValueError("Unexpected keyword arguments: " + ",".join(
+            arg for arg in kwargs))
+
+    if policy is not None:
+        return _recompute_with_policy(function, policy, preserve, offload,
+                                      *args)
+
+    return RecomputeFunction.apply(function, preserve, offload, *args)
+
+
+def recompute_sequential(functions, *args, **kwargs):
+    """
+    recompute a sequence of layers, split into segments automatically.
+
+    The layers are split into ``segments`` contiguous segments, every segment but the last one 
+    is recomputed in backward, the last one runs as usual since its activations are used by 
+    backward right away. By default sqrt(len(functions)) segments are used, which keeps the 
+    memory of the checkpointed activations in the order of sqrt(len(functions)).
+
+    A segment whose input does not need grad, e.g. the first one fed with a data tensor with 
+    stop_gradient=True, is not recomputed either. No grad node would be built for it and the 
+    parameters inside would get no gradient, so it runs as usual and keeps its activations.
+
+    Args:
+        functions(paddle.nn.Sequential|list): layers that run one after another, each one takes 
+        the output of the previous one as its only input.
+        segments(int, optional): number of segments to split functions into. Default None, use 
+        int(sqrt(len(functions))).
+        preserve_rng_state(bool, optional):  if preserve the RNG state of forward and restore it in backward. 
+        Same default as in recompute.
+        offload(bool, optional): if keep the segment inputs in CUDA pinned memory until backward, 
+        with the same cost as in recompute. Default False.
+        args: the input of the first layer
+
+    Returns:
+        Output of the last layer
+
+    Examples:
+        .. code-block:: python
+
+            import paddle
+            from paddle.distributed.fleet.utils import recompute_sequential
+
+            # required: gpu
+
+            model = paddle.nn.Sequential(*[paddle.nn.Linear(10, 10) for _ in range(9)])
+            x = paddle.rand([4, 10])
+            # split into 3 segments of 3 layers, the first one runs as usual
+            # since x does not need grad
+            y = recompute_sequential(model, x)
+    """
+    # Hack to mix *args with **kwargs in a python 2.7-compliant way
+    segments = kwargs.pop('segments', None)
+    preserve = kwargs.pop('preserve_rng_state', _PRESERVE_RNG_DEFAULT)
+    offload = kwargs.pop('offload', False)
     if kwargs:
         raise ValueError("Unexpected keyword arguments: " + ",".join(
             arg for arg in kwargs))
 
-    return RecomputeFunction.apply(function, preserve, *args)
+    if isinstance(functions, paddle.nn.Sequential):
+        functions = list(functions._sub_layers.values())
+    if len(functions) == 0:
+        raise ValueError("recompute_sequential needs at least one layer")
+    if len(args) != 1:
+        raise ValueError(
+            "recompute_sequential takes exactly one input, but got {} inputs".
+            format(len(args)))
+
+    if segments is None:
+        segments = max(int(math.sqrt(len(functions))), 1)
+    if segments < 1:
+        raise ValueError("segments should be a positive integer, but got {}".
+                         format(segments))
+    segments = min(segments, len(functions))
+
+    segment_size = len(functions) // segments
+    output = args[0]
+    # the last segment takes the remaining layers and is not recomputed
+    end = 0
+    for begin in range(0, segment_size * (segments - 1), segment_size):
+        end = begin + segment_size
+        run_function = _run_layers(functions[begin:end])
+        if isinstance(output, core.VarBase) and not output.stop_gradient:
+            output = RecomputeFunction.apply(run_function, preserve, offload,
+                                             output)
+        else:
+            output = run_function(output)
+    return _run_layers(functions[end:])(output)
@@ -19,7 +19,7 @@ import numpy as np
 
 import paddle
 from paddle.autograd import PyLayer
-from paddle.distributed.fleet.utils import recompute
+from paddle.distributed.fleet.utils import recompute, recompute_sequential
 import random
 
 import paddle.fluid.layers as layers
@@ -159,6 +159,172 @@ class TestPyLayer(unittest.TestCase):
         loss, param, grad = run_model(cuda_state, recompute_block=[1, 3])
         check_identical(loss_ref, param_ref, grad_ref, loss, param, grad)
 
+    def test_fc_net_with_policy(self):
+        from paddle.distributed.fleet.utils.recompute import RecomputeFunction
+
+        cuda_state = paddle.get_cuda_rng_state()
+        loss_ref, param_ref, grad_ref = run_model(
+            cuda_state, recompute_block=[])
+
+        # count the recompute segments the policy splits block 2 into
+        apply_calls = []
+        orig_apply = RecomputeFunction.apply
+
+        def counting_apply(*args):
+            apply_calls.append(args[0])
+            return orig_apply(*args)
+
+        def run_with_policy(policy):
+            del apply_calls[:]
+            RecomputeFunction.apply = counting_apply
+            try:
+                loss, param, grad = run_model(
+                    cuda_state,
+                    recompute_block=[2],
+                    recompute_kwargs={"policy": policy})
+            finally:
+                # apply is inherited from PyLayer
+                del RecomputeFunction.apply
+            self.assertEqual(loss_ref, loss)
+            self.assertEqual(param_ref, param)
+            self.assertEqual(grad_ref, grad)
+            # 10 steps in run_model
+            return len(apply_calls) // 10
+
+        # fc_0 | dropout, relu_1 | fc_1 | relu_2 | fc_2
+        self.assertEqual(run_with_policy('save_matmul'), 2)
+        self.assertEqual(run_with_policy('save_all'), 0)
+        self.assertEqual(run_with_policy('save_nothing'), 1)
+        # keep the relu outputs, recompute the linear and dropout layers:
+        # fc_0, dropout | relu_1 | fc_1 | relu_2 | fc_2
+        self.assertEqual(
+            run_with_policy(lambda layer: isinstance(layer, paddle.nn.ReLU)),
+            3)
+
+        with self.assertRaises(ValueError):
+            run_model(
+                cuda_state,
+                recompute_block=[2],
+                recompute_kwargs={"policy": "save_unknown"})
+
+    def test_recompute_dropout_on_later_call(self):
+        paddle.set_device("gpu")
+
+        class ConditionalDropout(paddle.nn.Layer):
+            def __init__(self):
+                super(ConditionalDropout, self).__init__()
+                self.fc = paddle.nn.Linear(10, 10)
+
+            def forward(self, x, use_dropout):
+                x = self.fc(x)
+                if use_dropout:
+                    x = paddle.nn.functional.dropout(x, p=0.5)
+                return x
+
+        def run(use_recompute):
+            paddle.seed(10)
+            np.random.seed(10)
+            layer = ConditionalDropout()
+            x = paddle.to_tensor(np.random.randn(4, 10).astype(np.float32))
+            x.stop_gradient = False
+            grads = []
+            # deterministic on the first call, dropout on the second one
+            for use_dropout in [False, True]:
+                if use_recompute:
+                    out = recompute(layer, x, use_dropout)
+                else:
+                    out = layer(x, use_dropout)
+                out.mean().backward()
+                grads.append(layer.fc.weight.gradient().tolist())
+                layer.clear_gradients()
+            return grads
+
+        self.assertEqual(run(False), run(True))
+
+    def test_recompute_sequential(self):
+        paddle.set_device("gpu")
+
+        def run_sequential(use_recompute, stop_gradient=False, **kwargs):
+            paddle.seed(10)
+            np.random.seed(10)
+            model = paddle.nn.Sequential(*[
+                get_fc_block(
+                    i, 10, is_last=(i == 4)) for i in range(5)
+            ])
+            x = paddle.to_tensor(np.random.randn(1, 10).astype(np.float32))
+            x.stop_gradient = stop_gradient
+            if use_recompute:
+                loss = recompute_sequential(model, x, **kwargs).mean()
+            else:
+                loss = model(x).mean()
+            loss.backward()
+            grads = [p.gradient() for p in model.parameters()]
+            return np.asarray(loss).tolist(), [
+                None if g is None else g.tolist() for g in grads
+            ]
+
+        loss_ref, grad_ref = run_sequential(False)
+        for kwargs in [{}, {"segments": 1}, {"segments": 3}, {"segments": 5}]:
+            loss, grad = run_sequential(True, **kwargs)
+            self.assertEqual(loss_ref, loss)
+            self.assertEqual(grad_ref, grad)
+
+        # the first segment gets a data tensor that needs no grad, its
+        # parameters must still get their gradients
+        loss_ref, grad_ref = run_sequential(False, stop_gradient=True)
+        for kwargs in [{}, {"segments": 5}]:
+            loss, grad = run_sequential(True, stop_gradient=True, **kwargs)
+            self.assertEqual(loss_ref, loss)
+            self.assertEqual(grad_ref, grad)
+
+        with self.assertRaises(ValueError):
+            run_sequential(True, segments=0)
+
+    def test_fc_net_with_offload(self):
+        paddle.set_device("gpu")
+        cuda_state = paddle.get_cuda_rng_state()
+        loss_ref, param_ref, grad_ref = run_model(
+            cuda_state, recompute_block=[])
+
+        # record where the saved inputs live between forward and backward
+        import paddle.distributed.fleet.utils.recompute as recompute_module
+        offload_tensor = recompute_module._offload_tensor
+        reload_tensor = recompute_module._reload_tensor
+        offloaded_places, reloaded_places = [], []
+
+        def record_offload(tensor):
+            out = offload_tensor(tensor)
+            offloaded_places.append(out.place)
+            return out
+
+        def record_reload(tensor, place):
+            out = reload_tensor(tensor, place)
+            reloaded_places.append(out.place)
+            return out
+
+        recompute_module._offload_tensor = record_offload
+        recompute_module._reload_tensor = record_reload
+        try:
+            loss, param, grad = run_model(
+                cuda_state,
+                recompute_block=[2],
+                recompute_kwargs={"offload": True})
+        finally:
+            recompute_module._offload_tensor = offload_tensor
+            recompute_module._reload_tensor = reload_tensor
+
+        self.assertEqual(loss_ref, loss)
+        self.assertEqual(param_ref, param)
+        self.assertEqual(grad_ref, grad)
+
+        # one input per step for the single recomputed block
+        self.assertEqual(len(offloaded_places), 10)
+        self.assertEqual(len(reloaded_places), 10)
+        for place in offloaded_places:
+            self.assertTrue(place.is_cuda_pinned_place())
+        for place in reloaded_places:
+            self.assertTrue(place.is_gpu_place())
+
     def test_recompute_kwargs(self):
         paddle.set_device("gpu")
         kwargs = {"is_test": False}